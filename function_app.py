@@ -1,49 +1,564 @@
 import logging
-import json
-import uuid
+import asyncio
+import secrets
 import os
-
+import threading
+import time
+import hashlib
+import functools
+import atexit
+import random
+from concurrent.futures import Future
+
+import aiohttp
 import azure.functions as func
-from azure.data.tables import TableServiceClient
+import httpx
+import orjson
+from cachetools import TTLCache
+from azure.core.pipeline.transport import AioHttpTransport
+from azure.data.tables import TableTransactionError
+from azure.data.tables.aio import TableClient, TableServiceClient
+from azure.data.tables.aio._policies_async import AsyncTablesRetryPolicy
 from azure.core.exceptions import ResourceNotFoundError
 from openai import AzureOpenAI
 
 
+# Los SDKs de Azure loguean cada request/response HTTP; los dejamos en WARNING
+# para que no dominen los logs ni el costo de formateo.
+logging.getLogger("azure").setLevel(logging.WARNING)
+
 # Function App (modelo v2 con decoradores)
 app = func.FunctionApp(http_auth_level=func.AuthLevel.ANONYMOUS)
 
-gpt4o_client = AzureOpenAI(
-    api_key=os.getenv("AZURE_OPENAI_API_KEY"),
-    api_version="2024-05-01-preview",  # ajusta si usas otra versión
-    azure_endpoint=os.getenv("AZURE_OPENAI_ENDPOINT"),
+# --- Clientes de Azure OpenAI ---
+# Se construyen en el primer uso: send_notification y
+# start_provisioning_workflow no los necesitan y no deberían pagar su
+# inicialización en el cold start.
+OPENAI_API_VERSION = "2024-05-01-preview"  # ajusta si usas otra versión
+OPENAI_HTTP_LIMITS = httpx.Limits(
+    max_keepalive_connections=50,
+    max_connections=100,
+    keepalive_expiry=60,
 )
+OPENAI_HTTP_TIMEOUT = httpx.Timeout(30.0, connect=5.0)
+
+_openai_init_lock = threading.Lock()
+
+
+@functools.cache
+def _build_gpt4o_client() -> AzureOpenAI:
+    # Cliente HTTP compartido: mantiene las conexiones TLS abiertas entre
+    # invocaciones para no pagar el handshake en cada llamada.
+    http_client = httpx.Client(limits=OPENAI_HTTP_LIMITS, timeout=OPENAI_HTTP_TIMEOUT)
+    atexit.register(http_client.close)
+    return AzureOpenAI(
+        api_key=os.getenv("AZURE_OPENAI_API_KEY"),
+        api_version=OPENAI_API_VERSION,
+        azure_endpoint=os.getenv("AZURE_OPENAI_ENDPOINT"),
+        http_client=http_client,
+    )
+
+
+def get_gpt4o_client() -> AzureOpenAI:
+    # run_gpt4o_advanced corre en el thread pool: el lock evita construir
+    # dos clientes si llegan invocaciones concurrentes en frío
+    with _openai_init_lock:
+        return _build_gpt4o_client()
+
+
+# System message fijo y siempre primero: el prompt caching de Azure OpenAI
+# funciona por prefijo exacto, así que no interpolar fechas, IDs de request
+# ni nada variable aquí.
+GPT4O_SYSTEM_PROMPT = (
+    "You are a senior IT support and corporate communication assistant. "
+    "Provide concise, clear and well-structured answers in Spanish, with tono profesional."
+)
+GPT4O_SYSTEM_MESSAGE = {"role": "system", "content": GPT4O_SYSTEM_PROMPT}
+
+GPT4O_MAX_TOKENS = 400
+
+# --- Cache semántico de prompts (GPT-4o) ---
+# Solo se activa si hay un deployment de embeddings configurado; numpy se
+# importa recién al usarlo, para no sumarlo al cold start de todas las rutas.
+EMBEDDING_DEPLOYMENT = os.getenv("AZURE_OPENAI_DEPLOYMENT_EMBEDDING")
+SEMANTIC_CACHE_THRESHOLD = 0.9
+SEMANTIC_CACHE_TTL = 3600  # segundos
+SEMANTIC_CACHE_MAXSIZE = 1000
+
+
+class SemanticCache:
+    """Cache en memoria de respuestas indexado por embeddings del prompt.
+
+    Cada entrada pertenece a un namespace (hash del system prompt), así que
+    un cambio en el system prompt invalida las respuestas anteriores.
+    """
+
+    def __init__(self, maxsize: int, ttl: float, threshold: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.threshold = threshold
+        self._lock = threading.Lock()
+        self._entries = []  # (namespace, answer, expires_at)
+        self._vectors = None  # matriz numpy, una fila por entrada
+
+    def _purge_expired(self, now: float) -> None:
+        if not self._entries:
+            return
+        keep = [i for i, e in enumerate(self._entries) if e[2] > now]
+        if len(keep) != len(self._entries):
+            self._entries = [self._entries[i] for i in keep]
+            self._vectors = self._vectors[keep]
+
+    def get(self, namespace: str, embedding) -> str | None:
+        import numpy as np
+
+        vector = _normalize(embedding)
+        with self._lock:
+            self._purge_expired(time.monotonic())
+            if not self._entries:
+                return None
+            scores = self._vectors @ vector
+            for i in np.argsort(scores)[::-1]:
+                if scores[i] <= self.threshold:
+                    return None
+                if self._entries[i][0] == namespace:
+                    return self._entries[i][1]
+        return None
+
+    def put(self, namespace: str, embedding, answer: str) -> None:
+        import numpy as np
+
+        vector = _normalize(embedding)
+        with self._lock:
+            self._purge_expired(time.monotonic())
+            if not self._entries:
+                self._vectors = vector[np.newaxis, :]
+            else:
+                self._vectors = np.vstack([self._vectors, vector])
+            self._entries.append((namespace, answer, time.monotonic() + self.ttl))
+            # Descartamos las entradas más antiguas si se supera el tamaño máximo
+            if len(self._entries) > self.maxsize:
+                overflow = len(self._entries) - self.maxsize
+                self._entries = self._entries[overflow:]
+                self._vectors = self._vectors[overflow:]
+
+
+def _normalize(embedding):
+    import numpy as np
+
+    vector = np.asarray(embedding, dtype=np.float32)
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm else vector
+
+
+def _system_prompt_hash(system_prompt: str) -> str:
+    return hashlib.blake2b(system_prompt.encode("utf-8"), digest_size=8).hexdigest()
+
+
+GPT4O_SYSTEM_HASH = _system_prompt_hash(GPT4O_SYSTEM_PROMPT)
+
+
+def _embed(text: str):
+    response = get_gpt4o_client().embeddings.create(model=EMBEDDING_DEPLOYMENT, input=text)
+    return response.data[0].embedding
+
+
+semantic_cache = SemanticCache(
+    maxsize=SEMANTIC_CACHE_MAXSIZE,
+    ttl=SEMANTIC_CACHE_TTL,
+    threshold=SEMANTIC_CACHE_THRESHOLD,
+) if EMBEDDING_DEPLOYMENT else None
+
+
+def _complete(prompt: str) -> str:
+    completion = get_gpt4o_client().chat.completions.create(
+        model=os.getenv("AZURE_OPENAI_DEPLOYMENT_GPT4O"),  # nombre del deployment de GPT-4o
+        messages=[
+            GPT4O_SYSTEM_MESSAGE,
+            {"role": "user", "content": prompt}
+        ],
+        max_tokens=GPT4O_MAX_TOKENS,
+        # temperature baja: mismas entradas -> respuestas equivalentes, seguro para cachear
+        temperature=0.2,
+    )
+    return completion.choices[0].message.content
+
+
+# Cache exacto (system_hash, prompt) -> answer. Va antes del cache semántico,
+# así los reintentos idénticos ni siquiera calculan el embedding. Mismo TTL
+# que el cache semántico para que ninguna respuesta viva más que allí.
+_completion_cache = TTLCache(maxsize=2048, ttl=SEMANTIC_CACHE_TTL)
+_completion_cache_lock = threading.Lock()
+
+
+def _cached_completion(system_hash: str, prompt: str) -> str:
+    key = (system_hash, prompt)
+    with _completion_cache_lock:
+        answer = _completion_cache.get(key)
+    if answer is not None:
+        return answer
+
+    embedding = None
+    cached_answer = None
+    if semantic_cache is not None:
+        try:
+            embedding = _embed(prompt)
+            cached_answer = semantic_cache.get(system_hash, embedding)
+        except Exception as e:
+            logging.warning("[CACHE] Semantic cache lookup failed: %s", e)
+
+    if cached_answer is not None:
+        # No se copia al cache exacto: renovaría el TTL de una respuesta
+        # que pertenece a otro prompt
+        logging.info("[CACHE] Semantic cache hit for run_gpt4o_advanced")
+        return cached_answer
+
+    answer = _complete(prompt)
+    # Respuestas vacías (p. ej. filtradas por contenido) no se cachean
+    if answer:
+        with _completion_cache_lock:
+            _completion_cache[key] = answer
+        if embedding is not None:
+            semantic_cache.put(system_hash, embedding, answer)
+    return answer
+
+
+# Requests idénticos en vuelo: el segundo espera el resultado del primero
+# en lugar de lanzar otra llamada a GPT-4o (p. ej. reintentos de un agente).
+_inflight: dict[str, Future] = {}
+_inflight_lock = threading.Lock()
+
+
+def _coalesced_completion(system_hash: str, prompt: str) -> str:
+    key = hashlib.blake2b(f"{system_hash}:{prompt}".encode("utf-8")).hexdigest()
+
+    with _inflight_lock:
+        future = _inflight.get(key)
+        is_owner = future is None
+        if is_owner:
+            future = Future()
+            _inflight[key] = future
+
+    if not is_owner:
+        return future.result()
+
+    try:
+        answer = _cached_completion(system_hash, prompt)
+        future.set_result(answer)
+        return answer
+    except BaseException as e:
+        future.set_exception(e)
+        raise
+    finally:
+        with _inflight_lock:
+            _inflight.pop(key, None)
+
 
 # --- Configuración de Table Storage ---
 CONNECTION_STRING = os.getenv("AzureWebJobsStorage")
 TABLE_NAME = "Tickets"
+TICKETS_PARTITION_KEY = "Tickets"
+
+# Campos fijos de todo ticket nuevo; create_ticket copia esta base y
+# completa el resto
+TICKET_ENTITY_BASE = {"PartitionKey": TICKETS_PARTITION_KEY, "status": "OPEN"}
+
+# Sesión aiohttp compartida (keep-alive) para todas las invocaciones: evita
+# un handshake TCP+TLS por cada operación contra Table Storage.
+#
+# Pool de 50 conexiones: con el tamaño por defecto las invocaciones
+# concurrentes de un mismo worker se encolan esperando conexión libre.
+# En planes Linux de consumo, cada conexión es un descriptor de archivo:
+# si se sube este valor, revisar que `ulimit -n` lo soporte.
+TABLE_HTTP_POOL_SIZE = int(os.getenv("TABLE_HTTP_POOL_SIZE", "50"))
+
+
+class JitteredTablesRetryPolicy(AsyncTablesRetryPolicy):
+    """Backoff exponencial con jitter: ante un 503 por throttling de la
+    partición, los reintentos de distintas invocaciones no llegan todos a la vez."""
+
+    def get_backoff_time(self, settings):
+        backoff = super().get_backoff_time(settings)
+        return backoff / 2 + random.uniform(0, backoff / 2)
+
+
+class JitteredTableServiceClient(TableServiceClient):
+    """TableServiceClient cuyo pipeline usa JitteredTablesRetryPolicy.
+
+    El SDK siempre arma su propia AsyncTablesRetryPolicy (ignora `retry_policy=`),
+    así que la reemplazamos en la lista de policies. Los TableClient que salen
+    de get_table_client comparten esa misma lista.
+    """
+
+    def _configure_policies(self, **kwargs):
+        return [
+            JitteredTablesRetryPolicy(**kwargs) if isinstance(policy, AsyncTablesRetryPolicy) else policy
+            for policy in super()._configure_policies(**kwargs)
+        ]
+
+
+# Reintentos por defecto del cliente, pensados para lecturas (get_ticket_status):
+# baratas de repetir, así que backoff inicial bajo.
+TABLE_READ_RETRY = {"retry_total": 5, "retry_backoff_factor": 0.5, "retry_backoff_max": 8}
+# Las escrituras reintentan menos y esperan más para no amplificar la ráfaga
+TABLE_WRITE_RETRY = {"retry_total": 3, "retry_backoff_factor": 1.0, "retry_backoff_max": 16}
+
+
+def _close_table_http_session(session: aiohttp.ClientSession, loop: asyncio.AbstractEventLoop) -> None:
+    # atexit no puede hacer await: si el loop del worker sigue abierto lo usamos
+    # para cerrar la sesión; si ya se cerró, sus sockets murieron con él y solo
+    # queda marcar la sesión como cerrada desde un loop nuevo.
+    if session.closed or loop.is_running():
+        return
+    if loop.is_closed():
+        asyncio.run(session.close())
+    else:
+        loop.run_until_complete(session.close())
+
+
+# El cliente async se crea en el primer uso: la sesión aiohttp tiene que
+# nacer dentro del event loop del worker, no al importar el módulo.
+@functools.cache
+def get_table_service() -> TableServiceClient:
+    table_http_session = aiohttp.ClientSession(
+        connector=aiohttp.TCPConnector(limit=TABLE_HTTP_POOL_SIZE)
+    )
+    atexit.register(_close_table_http_session, table_http_session, asyncio.get_running_loop())
+    table_transport = AioHttpTransport(session=table_http_session, session_owner=False)
+    return JitteredTableServiceClient.from_connection_string(
+        CONNECTION_STRING,
+        transport=table_transport,
+        **TABLE_READ_RETRY
+    )
 
-# Creamos el cliente de tabla
-table_service = TableServiceClient.from_connection_string(CONNECTION_STRING)
-table_client = table_service.get_table_client(TABLE_NAME)
+
+@functools.cache
+def _build_table_client() -> TableClient:
+    return get_table_service().get_table_client(TABLE_NAME)
+
+
+# La tabla se crea una sola vez por worker, en el primer uso, y nunca más:
+# un create_table_if_not_exists por operación agrega un round-trip a cada request.
+_table_ready = False
+_table_ready_lock = asyncio.Lock()
+
+
+async def get_table_client() -> TableClient:
+    global _table_ready
+
+    if not _table_ready:
+        async with _table_ready_lock:
+            if not _table_ready:
+                try:
+                    await get_table_service().create_table_if_not_exists(TABLE_NAME)
+                except Exception as e:
+                    # No reintentamos en cada request: si la tabla de verdad
+                    # no existe, las operaciones fallarán con su propio error
+                    logging.warning("[TABLE] Could not ensure table %s exists: %s", TABLE_NAME, e)
+                _table_ready = True
+
+    return _build_table_client()
+
+# Cache en memoria del estado de tickets (ticket_id -> status).
+# Los polls repetidos de get_ticket_status se sirven sin ir a Table Storage.
+_status_cache = TTLCache(maxsize=10000, ttl=30)
+_status_cache_lock = threading.Lock()
+
+# --- Escritura de tickets por lotes ---
+# En ráfagas (p. ej. un agente abriendo muchos tickets) agrupamos los upserts
+# en entity-group transactions: un solo round-trip para hasta 100 entidades.
+# Azure limita cada transacción a 100 entidades y 4 MiB de payload.
+# No se espera a juntar un lote: se toma lo que ya está encolado, así que con
+# poca carga cada ticket sale solo y sin demora.
+TICKET_BATCH_MAX_SIZE = 100
+TICKET_BATCH_MAX_BYTES = 4 * 1024 * 1024 - 64 * 1024  # margen para cabeceras del batch
+TICKET_SAVE_TIMEOUT = 60  # segundos
+
+# Timeouts por llamada de las escrituras, bastante por debajo de
+# TICKET_SAVE_TIMEOUT: una escritura lenta o colgada falla (y el agente lo sabe)
+# antes de que su caller se rinda. "timeout" acota también los reintentos.
+TABLE_WRITE_OPTIONS = {
+    **TABLE_WRITE_RETRY,
+    "connection_timeout": 5,
+    "read_timeout": 15,
+    "timeout": 40,
+}
+
+_ticket_queue = None
+_ticket_batch_task = None
+# Lotes escribiéndose a la vez: uno lento no bloquea al resto
+_ticket_flush_slots = asyncio.Semaphore(TABLE_HTTP_POOL_SIZE)
+_ticket_flush_tasks = set()
+
+
+def _resolve(future: asyncio.Future, error: Exception | None = None) -> None:
+    # El caller pudo haberse ido (timeout o cancelación)
+    if future.done():
+        return
+    if error is None:
+        future.set_result(None)
+    else:
+        future.set_exception(error)
+
+
+async def _upsert_ticket(table_client: TableClient, entity: dict, future: asyncio.Future) -> None:
+    try:
+        await table_client.upsert_entity(entity, **TABLE_WRITE_OPTIONS)
+    except Exception as e:
+        _resolve(future, e)
+    else:
+        _resolve(future)
+
+
+async def _flush_ticket_batch(batch: list) -> None:
+    # Si el caller ya se rindió (timeout) y respondió 500, no escribimos su
+    # ticket: el agente lo reintentaría y quedaría duplicado
+    batch = [item for item in batch if not item[1].done()]
+    if not batch:
+        return
+
+    try:
+        table_client = await get_table_client()
+        if len(batch) == 1:
+            # Con poca carga no vale la pena armar una transacción
+            entity, future, _ = batch[0]
+            await _upsert_ticket(table_client, entity, future)
+            return
+
+        await table_client.submit_transaction(
+            [("upsert", entity) for entity, _, _ in batch],
+            **TABLE_WRITE_OPTIONS
+        )
+        logging.info("[TABLE] Batch saved: %d tickets", len(batch))
+    except TableTransactionError as e:
+        # Una entidad inválida hace fallar toda la transacción: reintentamos
+        # una por una para que solo falle el ticket que corresponde
+        logging.warning("[TABLE] Batch of %d tickets failed, retrying individually: %s", len(batch), e)
+        await asyncio.gather(
+            *(_upsert_ticket(table_client, entity, future) for entity, future, _ in batch)
+        )
+        return
+    except Exception as e:
+        for _, future, _ in batch:
+            _resolve(future, e)
+        return
+
+    for _, future, _ in batch:
+        _resolve(future)
+
+
+async def _ticket_batch_worker(queue: asyncio.Queue) -> None:
+    loop = asyncio.get_running_loop()
+    pending = None
+
+    while True:
+        item = pending if pending is not None else await queue.get()
+        pending = None
+        # Mientras no haya un slot libre los tickets siguen encolándose y
+        # salen juntos en el próximo lote
+        await _ticket_flush_slots.acquire()
+        batch = [item]
+        batch_bytes = item[2]
+
+        # Solo acumulamos lo que ya llegó, sin esperar a juntar un lote
+        while len(batch) < TICKET_BATCH_MAX_SIZE and not queue.empty():
+            item = queue.get_nowait()
+            if item[1].done():
+                continue
+            if batch_bytes + item[2] > TICKET_BATCH_MAX_BYTES:
+                # No entra en esta transacción: abre el siguiente lote
+                pending = item
+                break
+            batch.append(item)
+            batch_bytes += item[2]
+
+        task = loop.create_task(_flush_ticket_batch(batch))
+        _ticket_flush_tasks.add(task)
+        task.add_done_callback(_ticket_flush_tasks.discard)
+        task.add_done_callback(lambda _: _ticket_flush_slots.release())
+
+
+async def save_ticket(entity: dict) -> None:
+    global _ticket_queue, _ticket_batch_task
+
+    loop = asyncio.get_running_loop()
+    if _ticket_queue is None:
+        _ticket_queue = asyncio.Queue()
+    if _ticket_batch_task is None or _ticket_batch_task.done():
+        # Primer uso, o el worker terminó por un error inesperado: lo relanzamos
+        # para que los tickets encolados no queden esperando para siempre
+        _ticket_batch_task = loop.create_task(_ticket_batch_worker(_ticket_queue))
+
+    future = loop.create_future()
+    await _ticket_queue.put((entity, future, len(orjson.dumps(entity))))
+    await asyncio.wait_for(future, TICKET_SAVE_TIMEOUT)
 
 
 def json_response(body: dict, status_code: int = 200) -> func.HttpResponse:
     return func.HttpResponse(
-        json.dumps(body),
+        orjson.dumps(body),
         status_code=status_code,
         mimetype="application/json"
     )
 
 
+def parse_json_body(req: func.HttpRequest) -> dict | None:
+    """Parsea el body con orjson. Devuelve None si no es un objeto JSON válido."""
+    try:
+        body = orjson.loads(req.get_body())
+    except orjson.JSONDecodeError:
+        return None
+    return body if isinstance(body, dict) else None
+
+
+# Respuestas de error frecuentes ya serializadas: no se re-codifican por request
+INVALID_JSON_BODY = orjson.dumps({"error": "Invalid JSON body"})
+
+
+EMPTY_BODY = orjson.dumps({"error": "Empty request body"})
+BODY_TOO_LARGE = orjson.dumps({"error": "Request body too large"})
+
+# Un token BPE ocupa al menos un byte, así que un body de 64 KiB nunca
+# supera el contexto de 128k tokens de GPT-4o (incluidos system prompt y
+# GPT4O_MAX_TOKENS). check_body_size aplica el límite sobre el body real en
+# todas las rutas, así que no hace falta tokenizar el prompt en el cliente.
+MAX_BODY_BYTES = 64 * 1024
+
+
+def invalid_json_response() -> func.HttpResponse:
+    return func.HttpResponse(
+        INVALID_JSON_BODY,
+        status_code=400,
+        mimetype="application/json"
+    )
+
+
+def check_body_size(req: func.HttpRequest) -> func.HttpResponse | None:
+    """Rechaza bodies vacíos o demasiado grandes antes de invocar el parser JSON.
+
+    Se mide el body ya recibido y no Content-Length: la cabecera puede
+    faltar (chunked) o no coincidir con lo que realmente llegó.
+    """
+    size = len(req.get_body())
+    if size == 0:
+        return func.HttpResponse(EMPTY_BODY, status_code=400, mimetype="application/json")
+    if size > MAX_BODY_BYTES:
+        return func.HttpResponse(BODY_TOO_LARGE, status_code=413, mimetype="application/json")
+    return None
+
+
 # 1) create_ticket - ahora persiste en Table Storage
 @app.route(route="create_ticket", methods=["POST"])
-def create_ticket(req: func.HttpRequest) -> func.HttpResponse:
+async def create_ticket(req: func.HttpRequest) -> func.HttpResponse:
     logging.info("create_ticket called")
 
-    try:
-        body = req.get_json()
-    except ValueError:
-        return json_response({"error": "Invalid JSON body"}, 400)
+    error = check_body_size(req)
+    if error is not None:
+        return error
+
+    body = parse_json_body(req)
+    if body is None:
+        return invalid_json_response()
 
     user_id = body.get("user_id")
     issue_description = body.get("issue_description")
@@ -54,22 +569,21 @@ def create_ticket(req: func.HttpRequest) -> func.HttpResponse:
             400
         )
 
-    ticket_id = f"INC-{uuid.uuid4().hex[:8].upper()}"
-    status = "OPEN"
+    ticket_id = f"INC-{secrets.token_hex(4).upper()}"
+    status = TICKET_ENTITY_BASE["status"]
 
-    entity = {
-        "PartitionKey": "Tickets",
-        "RowKey": ticket_id,
-        "user_id": user_id,
-        "issue_description": issue_description,
-        "status": status
-    }
+    entity = TICKET_ENTITY_BASE.copy()
+    entity["RowKey"] = ticket_id
+    entity["user_id"] = user_id
+    entity["issue_description"] = issue_description
 
     try:
-        table_client.upsert_entity(entity)
-        logging.info(f"[TABLE] Ticket saved: {ticket_id}")
+        await save_ticket(entity)
+        logging.info("[TABLE] Ticket saved: %s", ticket_id)
+        with _status_cache_lock:
+            _status_cache[ticket_id] = status
     except Exception as e:
-        logging.error(f"[TABLE] Error saving ticket {ticket_id}: {e}")
+        logging.error("[TABLE] Error saving ticket %s: %s", ticket_id, e)
         # IMPORTANTE: no decirle al agente que se creó si falló el insert. Prueba.
         return json_response(
             {"error": "Error saving ticket in storage"},
@@ -84,44 +598,64 @@ def create_ticket(req: func.HttpRequest) -> func.HttpResponse:
 
 # 2) get_ticket_status - lee desde Table Storage
 @app.route(route="get_ticket_status", methods=["POST"])
-def get_ticket_status(req: func.HttpRequest) -> func.HttpResponse:
+async def get_ticket_status(req: func.HttpRequest) -> func.HttpResponse:
     logging.info("get_ticket_status called")
 
-    try:
-        body = req.get_json()
-    except ValueError:
-        return json_response({"error": "Invalid JSON body"}, 400)
+    error = check_body_size(req)
+    if error is not None:
+        return error
+
+    body = parse_json_body(req)
+    if body is None:
+        return invalid_json_response()
 
     ticket_id = body.get("ticket_id")
     if not ticket_id:
         return json_response({"error": "Missing required field: ticket_id"}, 400)
 
+    with _status_cache_lock:
+        status = _status_cache.get(ticket_id)
+    if status is not None:
+        logging.info("[CACHE] Ticket found: %s -> %s", ticket_id, status)
+        return json_response(
+            {"ticket_id": ticket_id, "status": status},
+            200
+        )
+
     try:
-        entity = table_client.get_entity(
-            partition_key="Tickets",
-            row_key=ticket_id
+        table_client = await get_table_client()
+        # Solo pedimos "status": no descargamos issue_description en cada poll
+        entity = await table_client.get_entity(
+            partition_key=TICKETS_PARTITION_KEY,
+            row_key=ticket_id,
+            select=["status"]
         )
         status = entity.get("status", "UNKNOWN")
-        logging.info(f"[TABLE] Ticket found: {ticket_id} -> {status}")
+        logging.info("[TABLE] Ticket found: %s -> %s", ticket_id, status)
+        with _status_cache_lock:
+            _status_cache[ticket_id] = status
         return json_response(
             {"ticket_id": ticket_id, "status": status},
             200
         )
 
     except ResourceNotFoundError:
-        logging.warning(f"[TABLE] Ticket not found: {ticket_id}")
+        logging.warning("[TABLE] Ticket not found: %s", ticket_id)
         return json_response({"error": "Ticket not found"}, 404)
 
 
 # 3) send_notification (mock)
 @app.route(route="send_notification", methods=["POST"])
-def send_notification(req: func.HttpRequest) -> func.HttpResponse:
+async def send_notification(req: func.HttpRequest) -> func.HttpResponse:
     logging.info("send_notification called")
 
-    try:
-        body = req.get_json()
-    except ValueError:
-        return json_response({"error": "Invalid JSON body"}, 400)
+    error = check_body_size(req)
+    if error is not None:
+        return error
+
+    body = parse_json_body(req)
+    if body is None:
+        return invalid_json_response()
 
     user_id = body.get("user_id")
     message = body.get("message")
@@ -132,20 +666,23 @@ def send_notification(req: func.HttpRequest) -> func.HttpResponse:
             400
         )
 
-    logging.info(f"[NOTIFICATION] To user {user_id}: {message}")
+    logging.info("[NOTIFICATION] To user %s: %s", user_id, message)
 
     return json_response({"success": True}, 200)
 
 
 # 4) start_provisioning_workflow - mock
 @app.route(route="start_provisioning_workflow", methods=["POST"])
-def start_provisioning_workflow(req: func.HttpRequest) -> func.HttpResponse:
+async def start_provisioning_workflow(req: func.HttpRequest) -> func.HttpResponse:
     logging.info("start_provisioning_workflow called")
 
-    try:
-        body = req.get_json()
-    except ValueError:
-        return json_response({"error": "Invalid JSON body"}, 400)
+    error = check_body_size(req)
+    if error is not None:
+        return error
+
+    body = parse_json_body(req)
+    if body is None:
+        return invalid_json_response()
 
     user_id = body.get("user_id")
     request_type = body.get("request_type")
@@ -156,10 +693,10 @@ def start_provisioning_workflow(req: func.HttpRequest) -> func.HttpResponse:
             400
         )
 
-    workflow_id = f"WF-{uuid.uuid4().hex[:8].upper()}"
+    workflow_id = f"WF-{secrets.token_hex(4).upper()}"
     logging.info(
-        f"[WORKFLOW] Starting workflow {workflow_id} "
-        f"for user {user_id} with request_type={request_type}"
+        "[WORKFLOW] Starting workflow %s for user %s with request_type=%s",
+        workflow_id, user_id, request_type
     )
 
     return json_response(
@@ -168,46 +705,55 @@ def start_provisioning_workflow(req: func.HttpRequest) -> func.HttpResponse:
     )
 
 # 4) Modelo GTP 4o
+# Sin streaming: func.HttpResponse no acepta un body generador, y el HTTP
+# streaming de Azure Functions (extensión FastAPI) se activa para todo el
+# worker, obligando a migrar todas las rutas a sus tipos Request/Response.
 @app.route(route="run_gpt4o_advanced", methods=["POST"])
 def run_gpt4o_advanced(req: func.HttpRequest) -> func.HttpResponse:
+    error = check_body_size(req)
+    if error is not None:
+        return error
+
+    body = parse_json_body(req)
+    if body is None:
+        return invalid_json_response()
+
     try:
-        body = req.get_json()
         prompt = body.get("prompt")
 
         if not prompt:
             return func.HttpResponse(
-                json.dumps({"error": "El campo 'prompt' es obligatorio."}),
+                orjson.dumps({"error": "El campo 'prompt' es obligatorio."}),
                 status_code=400,
                 mimetype="application/json"
             )
 
-        completion = gpt4o_client.chat.completions.create(
-            model=os.getenv("AZURE_OPENAI_DEPLOYMENT_GPT4O"),  # nombre del deployment de GPT-4o
-            messages=[
-                {
-                    "role": "system",
-                    "content": (
-                        "You are a senior IT support and corporate communication assistant. "
-                        "Provide concise, clear and well-structured answers in Spanish, with tono profesional."
-                    )
-                },
-                {"role": "user", "content": prompt}
-            ],
-            max_tokens=400,
-            temperature=0.2,
-        )
+        # "no_cache": true para prompts sensibles que no deben guardarse.
+        # Los prompts que no son texto (p. ej. content parts) van directo:
+        # los caches indexan por el string del prompt.
+        if body.get("no_cache") or not isinstance(prompt, str):
+            answer = _complete(prompt)
+        else:
+            answer = _coalesced_completion(GPT4O_SYSTEM_HASH, prompt)
 
-        answer = completion.choices[0].message.content
+        # ?format=text devuelve la respuesta tal cual, sin escaparla a JSON
+        if req.params.get("format") == "text":
+            return func.HttpResponse(
+                answer or "",
+                status_code=200,
+                mimetype="text/plain",
+                charset="utf-8"
+            )
 
         return func.HttpResponse(
-            json.dumps({"answer": answer}),
+            orjson.dumps({"answer": answer}),
             status_code=200,
             mimetype="application/json"
         )
 
     except Exception as e:
         return func.HttpResponse(
-            json.dumps({"error": str(e)}),
+            orjson.dumps({"error": str(e)}),
             status_code=500,
             mimetype="application/json"
         )